@@ -6,13 +6,25 @@ for extracurricular activities at Mergington High School.
 Activity and participant data is persisted in a SQLite database.
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import RedirectResponse
+import anyio
+import hashlib
+import json
 import os
+import threading
+from collections import Counter
 from pathlib import Path
 from typing import Optional
-from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlalchemy import (
+    Connection, MetaData, UniqueConstraint, delete, event, exists, insert, make_url, update,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlmodel import Field, Relationship, Session, SQLModel, create_engine, select
 
 # ---------------------------------------------------------------------------
 # Database models
@@ -24,28 +36,176 @@ class Activity(SQLModel, table=True):
     description: str
     schedule: str
     max_participants: int
+    # Kept in step with the participant table so capacity checks need no COUNT
+    current_participants: int = Field(default=0)
+
+    participants: list["Participant"] = Relationship(
+        back_populates="activity",
+        sa_relationship_kwargs={"order_by": "Participant.id"},
+    )
+
+
+class Student(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    email: str = Field(index=True, unique=True)
+
+
+class RosterVersion(SQLModel, table=True):
+    # Single row, bumped by every signup/unregister so each worker process can
+    # tell whether its cached /activities response is stale
+    id: Optional[int] = Field(default=None, primary_key=True)
+    version: int = Field(default=0)
 
 
 class Participant(SQLModel, table=True):
+    # The composite unique index also serves lookups by activity_name alone
+    __table_args__ = (
+        UniqueConstraint("activity_name", "student_id", name="uq_participant_activity_student"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    email: str
+    student_id: int = Field(foreign_key="student.id", index=True)
     activity_name: str = Field(foreign_key="activity.name")
 
+    activity: Optional[Activity] = Relationship(back_populates="participants")
+    student: Optional[Student] = Relationship()
+
 
 # ---------------------------------------------------------------------------
 # Database setup
 # ---------------------------------------------------------------------------
 
 current_dir = Path(__file__).parent
-DATABASE_URL = f"sqlite:///{current_dir}/database.db"
-engine = create_engine(DATABASE_URL, echo=False)
-
-
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
-
+# Set DATABASE_URL=sqlite:///file::memory:?cache=shared&uri=true for a
+# non-durable in-memory database (demos, tests)
+DATABASE_URL = os.getenv("DATABASE_URL") or f"sqlite:///{current_dir}/database.db"
+
+
+def _is_in_memory(url: str) -> bool:
+    parsed = make_url(url)
+    database = parsed.database or ""
+    return (
+        database in ("", ":memory:")
+        or database.startswith("file::memory:")
+        or parsed.query.get("mode") == "memory"
+    )
+
+
+if _is_in_memory(DATABASE_URL):
+    # An in-memory database lives only as long as its connection, so every
+    # thread has to share the same one
+    _pool_options = {"poolclass": StaticPool}
+else:
+    _pool_options = {
+        "poolclass": QueuePool,
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_pre_ping": True,
+    }
 
-# Seed data – only inserted when the activities table is empty
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    connect_args={"check_same_thread": False, "timeout": 30},
+    **_pool_options,
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+    """Use WAL journaling so readers don't block writers and commits don't fsync."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# Stored in SQLite's user_version. On startup a database stamped with an older
+# version is rebuilt with the current schema, carrying over its activities and
+# signups, so bump this whenever the schema changes.
+SCHEMA_VERSION = 3
+
+_ROSTER_ACTIVITY_FIELDS = ("name", "description", "schedule", "max_participants")
+
+
+def read_existing_rosters(
+    connection: Connection,
+) -> Optional[tuple[list[dict], list[tuple[str, str]]]]:
+    """Read activities and (activity_name, email) signups from any earlier schema.
+
+    Returns None when there is no activity data to keep.
+    """
+    existing = MetaData()
+    existing.reflect(connection)
+    activity = existing.tables.get("activity")
+    if activity is None:
+        return None
+    activities = [
+        dict(row)
+        for row in connection.execute(
+            select(*(activity.c[field] for field in _ROSTER_ACTIVITY_FIELDS))
+            .order_by(activity.c.id)
+        ).mappings()
+    ]
+    if not activities:
+        return None
+
+    participant = existing.tables.get("participant")
+    if participant is None:
+        return activities, []
+    if "email" in participant.c:
+        # Schema versions 0 and 1 stored the email on the participant row
+        query = select(participant.c.activity_name, participant.c.email)
+    else:
+        student = existing.tables["student"]
+        query = select(participant.c.activity_name, student.c.email).join(
+            student, participant.c.student_id == student.c.id
+        )
+    names = {data["name"] for data in activities}
+    signups = [
+        (name, email)
+        for name, email in dict.fromkeys(
+            connection.execute(query.order_by(participant.c.id)).tuples()
+        )
+        if name in names
+    ]
+    return activities, signups
+
+
+def drop_db_tables(connection: Connection):
+    # Reflect rather than use SQLModel.metadata so tables from older schemas go too
+    existing = MetaData()
+    existing.reflect(connection)
+    existing.drop_all(connection)
+
+
+def create_db_and_tables(connection: Connection):
+    SQLModel.metadata.create_all(connection)
+
+
+if _is_in_memory(DATABASE_URL):
+    # Every session shares the one StaticPool connection, whose transactions
+    # would interleave, so requests take turns. The lock is awaited on the event
+    # loop rather than in a worker thread so waiting requests cannot exhaust the
+    # threadpool the lock holder needs to finish. Startup runs before any
+    # request is served and needs no lock.
+    _session_lock = anyio.Lock()
+
+    async def get_session():
+        async with _session_lock:
+            with Session(engine) as session:
+                yield session
+else:
+    def get_session():
+        with Session(engine) as session:
+            yield session
+
+
+# Seed data – inserted when the database is created empty
 SEED_ACTIVITIES = [
     {"name": "Chess Club", "description": "Learn strategies and compete in chess tournaments",
      "schedule": "Fridays, 3:30 PM - 5:00 PM", "max_participants": 12,
@@ -77,23 +237,59 @@ SEED_ACTIVITIES = [
 ]
 
 
-def seed_database():
-    with Session(engine) as session:
-        existing = session.exec(select(Activity)).first()
-        if existing:
-            return  # Already seeded
-        for data in SEED_ACTIVITIES:
-            activity = Activity(
-                name=data["name"],
-                description=data["description"],
-                schedule=data["schedule"],
-                max_participants=data["max_participants"],
-            )
-            session.add(activity)
-            session.flush()  # so activity.name is available
-            for email in data["participants"]:
-                session.add(Participant(email=email, activity_name=activity.name))
-        session.commit()
+def load_rosters(
+    connection: Connection, activities: list[dict], signups: list[tuple[str, str]]
+):
+    # Core inserts skip the ORM unit of work; the caller owns the transaction
+    counts = Counter(name for name, _ in signups)
+    connection.execute(insert(Activity), [
+        {**data, "current_participants": counts[data["name"]]} for data in activities
+    ])
+    if signups:
+        emails = list(dict.fromkeys(email for _, email in signups))
+        student_ids = dict(connection.execute(
+            insert(Student).returning(Student.email, Student.id, sort_by_parameter_order=True),
+            [{"email": email} for email in emails],
+        ).all())
+        connection.execute(insert(Participant), [
+            {"student_id": student_ids[email], "activity_name": name}
+            for name, email in signups
+        ])
+    connection.execute(insert(RosterVersion).values(id=1, version=0))
+
+
+def seed_database(connection: Connection):
+    load_rosters(
+        connection,
+        [{field: data[field] for field in _ROSTER_ACTIVITY_FIELDS} for data in SEED_ACTIVITIES],
+        [(data["name"], email) for data in SEED_ACTIVITIES for email in data["participants"]],
+    )
+
+
+def init_db():
+    """Create or upgrade the database unless it is already at SCHEMA_VERSION.
+
+    An empty database is seeded. A database from an older schema is rebuilt
+    with its existing activities and signups carried over.
+    """
+    with engine.connect() as connection:
+        if connection.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            return
+        # Take the write lock and check again so concurrent workers only
+        # initialize the database once
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        if connection.exec_driver_sql("PRAGMA user_version").scalar() >= SCHEMA_VERSION:
+            connection.rollback()
+            return
+        rosters = read_existing_rosters(connection)
+        drop_db_tables(connection)
+        create_db_and_tables(connection)
+        if rosters is None:
+            seed_database(connection)
+        else:
+            load_rosters(connection, *rosters)
+        connection.exec_driver_sql(f"PRAGMA user_version={SCHEMA_VERSION}")
+        connection.commit()
 
 
 # ---------------------------------------------------------------------------
@@ -108,8 +304,10 @@ app.mount("/static", StaticFiles(directory=os.path.join(current_dir, "static")),
 
 @app.on_event("startup")
 def on_startup():
-    create_db_and_tables()
-    seed_database()
+    init_db()
+    with Session(engine) as session:
+        _load_activity_meta(session)
+        _activities_snapshot(session)  # warm the /activities cache
 
 
 # ---------------------------------------------------------------------------
@@ -125,89 +323,187 @@ def _activity_to_dict(activity: Activity, participants: list[str]) -> dict:
     }
 
 
+def _load_activities(session: Session) -> dict[str, dict]:
+    # Load every activity, then all of their participants in one extra query
+    activities = session.exec(
+        select(Activity)
+        .options(selectinload(Activity.participants).joinedload(Participant.student))
+        .order_by(Activity.id)
+    ).all()
+    return {
+        activity.name: _activity_to_dict(activity, [p.student.email for p in activity.participants])
+        for activity in activities
+    }
+
+
+# The activity catalog is fixed at runtime, so write endpoints resolve names to
+# (id, max_participants) here instead of querying the activity table.
+_activity_meta: dict[str, tuple[int, int]] = {}
+
+
+def _load_activity_meta(session: Session):
+    rows = session.exec(select(Activity.name, Activity.id, Activity.max_participants)).all()
+    _activity_meta.clear()
+    _activity_meta.update(
+        {name: (activity_id, max_participants) for name, activity_id, max_participants in rows}
+    )
+
+
+def _get_activity_meta(activity_name: str) -> tuple[int, int]:
+    meta = _activity_meta.get(activity_name)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Activity not found")
+    return meta
+
+
+# The /activities response only changes on signup/unregister, so it is cached
+# here together with its ETag. Writes bump the shared RosterVersion row, which
+# lets every worker process detect that its copy is stale.
+_activities_cache: Optional[tuple[int, dict[str, dict], str]] = None
+_cache_lock = threading.Lock()
+
+
+def _roster_version(session: Session) -> int:
+    return session.exec(select(RosterVersion.version).where(RosterVersion.id == 1)).one()
+
+
+def _bump_roster_version(session: Session):
+    session.execute(
+        update(RosterVersion)
+        .where(RosterVersion.id == 1)
+        .values(version=RosterVersion.version + 1)
+    )
+
+
+def _activities_snapshot(session: Session) -> tuple[dict[str, dict], str]:
+    global _activities_cache
+    # Read the version before the rosters: a write landing in between only
+    # labels newer data with an older version, which forces a reload later
+    # instead of serving stale data
+    version = _roster_version(session)
+    cached = _activities_cache
+    if cached is None or cached[0] != version:
+        with _cache_lock:
+            cached = _activities_cache
+            if cached is None or cached[0] != version:
+                activities = _load_activities(session)
+                digest = hashlib.blake2b(
+                    json.dumps(activities, sort_keys=True).encode(), digest_size=8
+                ).hexdigest()
+                cached = _activities_cache = (version, activities, f'"{digest}"')
+    return cached[1], cached[2]
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses weak comparison (RFC 9110), so W/"x" matches "x"
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
 # ---------------------------------------------------------------------------
 # Routes
 # ---------------------------------------------------------------------------
 
+# Built once and shared by every request. FastAPI attaches the first request's
+# background tasks to a returned response whose background is None, so root()
+# must not take dependencies that schedule background tasks.
+_ROOT_REDIRECT = RedirectResponse(url="/static/index.html")
+
+
 @app.get("/")
 def root():
-    return RedirectResponse(url="/static/index.html")
+    return _ROOT_REDIRECT
 
 
 @app.get("/activities")
-def get_activities():
-    with Session(engine) as session:
-        activities = session.exec(select(Activity)).all()
-        result = {}
-        for activity in activities:
-            participants = session.exec(
-                select(Participant).where(Participant.activity_name == activity.name)
-            ).all()
-            result[activity.name] = _activity_to_dict(
-                activity, [p.email for p in participants]
-            )
-        return result
+def get_activities(
+    request: Request, response: Response, session: Session = Depends(get_session)
+) -> dict[str, dict]:
+    activities, etag = _activities_snapshot(session)
+    # Return the connection to the pool now: FastAPI validates the response in
+    # the threadpool, and holding a connection while waiting for a free thread
+    # deadlocks once every thread is itself waiting for a connection
+    session.close()
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return activities
 
 
 @app.post("/activities/{activity_name}/signup")
-def signup_for_activity(activity_name: str, email: str):
+def signup_for_activity(
+    activity_name: str, email: str, session: Session = Depends(get_session)
+) -> dict[str, str]:
     """Sign up a student for an activity"""
-    with Session(engine) as session:
-        # Validate activity exists
-        activity = session.exec(
-            select(Activity).where(Activity.name == activity_name)
-        ).first()
-        if not activity:
-            raise HTTPException(status_code=404, detail="Activity not found")
-
-        # Validate student is not already signed up
-        existing = session.exec(
-            select(Participant).where(
+    activity_id, max_participants = _get_activity_meta(activity_name)
+
+    # Claim a seat only if the activity has room, then add the student; the
+    # unique constraint rolls both back on a duplicate signup
+    claimed = session.execute(
+        update(Activity)
+        .where(
+            Activity.id == activity_id,
+            Activity.current_participants < max_participants,
+        )
+        .values(current_participants=Activity.current_participants + 1)
+    ).rowcount
+    if claimed:
+        session.execute(
+            sqlite_insert(Student).values(email=email).on_conflict_do_nothing()
+        )
+        student_id = session.exec(select(Student.id).where(Student.email == email)).one()
+        session.add(Participant(student_id=student_id, activity_name=activity_name))
+        try:
+            _bump_roster_version(session)
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise HTTPException(status_code=400, detail="Student is already signed up")
+    else:
+        # Work out why no seat could be claimed
+        already_signed_up = session.exec(
+            select(exists().where(
                 Participant.activity_name == activity_name,
-                Participant.email == email
-            )
-        ).first()
-        if existing:
+                Participant.student_id == Student.id,
+                Student.email == email,
+            ))
+        ).one()
+        if already_signed_up:
             raise HTTPException(status_code=400, detail="Student is already signed up")
+        raise HTTPException(status_code=400, detail="Activity is full")
 
-        # Validate capacity
-        participant_count = len(session.exec(
-            select(Participant).where(Participant.activity_name == activity_name)
-        ).all())
-        if participant_count >= activity.max_participants:
-            raise HTTPException(status_code=400, detail="Activity is full")
-
-        # Add student
-        session.add(Participant(email=email, activity_name=activity_name))
-        session.commit()
-        return {"message": f"Signed up {email} for {activity_name}"}
+    return {"message": f"Signed up {email} for {activity_name}"}
 
 
 @app.delete("/activities/{activity_name}/unregister")
-def unregister_from_activity(activity_name: str, email: str):
+def unregister_from_activity(
+    activity_name: str, email: str, session: Session = Depends(get_session)
+) -> dict[str, str]:
     """Unregister a student from an activity"""
-    with Session(engine) as session:
-        # Validate activity exists
-        activity = session.exec(
-            select(Activity).where(Activity.name == activity_name)
-        ).first()
-        if not activity:
-            raise HTTPException(status_code=404, detail="Activity not found")
-
-        # Find the participant record
-        participant = session.exec(
-            select(Participant).where(
-                Participant.activity_name == activity_name,
-                Participant.email == email
-            )
-        ).first()
-        if not participant:
-            raise HTTPException(
-                status_code=400,
-                detail="Student is not signed up for this activity"
-            )
-
-        # Remove student
-        session.delete(participant)
-        session.commit()
-        return {"message": f"Unregistered {email} from {activity_name}"}
+    activity_id, _ = _get_activity_meta(activity_name)
+
+    # Remove student without loading the participant row
+    removed = session.execute(
+        delete(Participant).where(
+            Participant.activity_name == activity_name,
+            Participant.student_id == (
+                select(Student.id).where(Student.email == email).scalar_subquery()
+            ),
+        )
+    ).rowcount
+    if not removed:
+        raise HTTPException(
+            status_code=400,
+            detail="Student is not signed up for this activity"
+        )
+
+    session.execute(
+        update(Activity)
+        .where(Activity.id == activity_id)
+        .values(current_participants=Activity.current_participants - 1)
+    )
+    _bump_roster_version(session)
+    session.commit()
+    return {"message": f"Unregistered {email} from {activity_name}"}